@@ -1,86 +1,186 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
-from datetime import datetime, timedelta
-import os, sqlite3, secrets, string
-from contextlib import closing
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory, g
+import os, sqlite3, secrets, string, time, hmac, queue
+import orjson
 from dotenv import load_dotenv
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
 
 # Load env
 load_dotenv(override=True)
 
+_QUOTES = ('"', "'")
+
 def _clean(s: str) -> str:
     s = (s or "").strip()
-    if (s.startswith('"') and s.endswith('"')) or (s.startswith("'") and s.endswith("'")):
-        s = s[1:-1].strip()
+    if s and s[0] in _QUOTES and s[0] == s[-1]:
+        return s[1:-1].strip()
     return s
 
 ADMIN_USER = _clean(os.getenv("ADMIN_USER", "admin"))
 ADMIN_PASSWORD = _clean(os.getenv("ADMIN_PASSWORD", "fluxadmin"))
 SECRET_KEY = _clean(os.getenv("SECRET_KEY", "change-this-secret"))
 DATABASE = _clean(os.getenv("DATABASE", "flux.db"))
+FLUX_DEBUG = _clean(os.getenv("FLUX_DEBUG", "0")) == "1"
+_ADMIN_USER_B = ADMIN_USER.encode()
+_ADMIN_PW_B = ADMIN_PASSWORD.encode()
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 app = Flask(__name__, static_folder=os.path.join(BASE_DIR, "static"), template_folder=os.path.join(BASE_DIR, "templates"))
 app.secret_key = SECRET_KEY
+app.config["TEMPLATES_AUTO_RELOAD"] = FLUX_DEBUG
 app.config["MAX_CONTENT_LENGTH"] = 5 * 1024 * 1024  # 5MB uploads
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 3600  # let browsers cache static files
 ALLOWED_LOGO_EXT = {"png", "jpg", "jpeg", "webp", "ico"}
+_STATIC = app.static_folder
+_LOGO_PATH = os.path.join(_STATIC, "logo.png")
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()  # compiled templates in the temp dir
+# kept on disk next to the database so every worker process sees the same
+# entries and invalidations
+cache = Cache(app, config={
+    "CACHE_TYPE": "FileSystemCache",
+    "CACHE_DIR": os.path.join(os.path.dirname(os.path.abspath(DATABASE)), ".flux_cache"),
+    "CACHE_DEFAULT_TIMEOUT": 5,
+})
 
 # ---------- DB helpers ----------
-def get_db():
-    conn = sqlite3.connect(DATABASE, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+# Connections are kept open in a small pool and handed out one per app
+# context (i.e. per request). They may be returned from a different thread
+# than the one that opened them, hence check_same_thread=False. Autocommit
+# mode: every statement commits on its own.
+_POOL_SIZE = 8
+
+# api_validate's upsert relies on INSERT ... RETURNING (SQLite 3.35+)
+if sqlite3.sqlite_version_info < (3, 35, 0):
+    raise RuntimeError(f"Flux needs SQLite 3.35 or newer, this Python links SQLite {sqlite3.sqlite_version}")
+_pool = queue.LifoQueue(maxsize=_POOL_SIZE)
+
+def _connect():
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")  # ~20MB page cache
     return conn
 
+def get_db():
+    if "db" not in g:
+        try:
+            g.db = _pool.get_nowait()
+        except queue.Empty:
+            g.db = _connect()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    db = g.pop("db", None)
+    if db is None:
+        return
+    try:
+        _pool.put_nowait(db)
+    except queue.Full:
+        db.close()
+
 def init_db():
-    with closing(get_db()) as db:
-        cur = db.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS licenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                lic_key TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP NOT NULL,
-                expires_at TIMESTAMP,
-                max_activations INTEGER NOT NULL DEFAULT 1,
-                revoked INTEGER NOT NULL DEFAULT 0,
-                notes TEXT
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS activations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                license_id INTEGER NOT NULL,
-                machine_id TEXT NOT NULL,
-                activated_at TIMESTAMP NOT NULL,
-                last_seen TIMESTAMP NOT NULL,
-                UNIQUE(license_id, machine_id),
-                FOREIGN KEY(license_id) REFERENCES licenses(id) ON DELETE CASCADE
-            )
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS licenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lic_key TEXT UNIQUE NOT NULL CHECK (lic_key = upper(lic_key)),
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER,
+            max_activations INTEGER NOT NULL DEFAULT 1,
+            revoked INTEGER NOT NULL DEFAULT 0,
+            notes TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS activations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            license_id INTEGER NOT NULL,
+            machine_id TEXT NOT NULL,
+            activated_at INTEGER NOT NULL,
+            last_seen INTEGER NOT NULL,
+            UNIQUE(license_id, machine_id),
+            FOREIGN KEY(license_id) REFERENCES licenses(id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    # timestamps used to be stored as ISO text; they are now epoch seconds (UTC)
+    for table, col in (("licenses", "created_at"), ("licenses", "expires_at"),
+                       ("activations", "activated_at"), ("activations", "last_seen")):
+        cur.execute(f"""
+            UPDATE {table} SET {col} = COALESCE(CAST(strftime('%s', {col}) AS INTEGER), 0)
+            WHERE typeof({col}) = 'text'
         """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        """)
-        # defaults
-        cur.execute("INSERT OR IGNORE INTO settings(key,value) VALUES('site_name','Flux Licensing')")
-        cur.execute("INSERT OR IGNORE INTO settings(key,value) VALUES('accent','fuchsia')")
-        db.commit()
+    # lic_key and (license_id, machine_id) are already covered by their UNIQUE indexes
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_licenses_created_at ON licenses(created_at)")
+    # defaults
+    cur.execute("INSERT OR IGNORE INTO settings(key,value) VALUES('site_name','Flux Licensing')")
+    cur.execute("INSERT OR IGNORE INTO settings(key,value) VALUES('accent','fuchsia')")
 
-@app.before_request
-def ensure_db():
+# create schema once at startup instead of on every request
+with app.app_context():
     init_db()
 
 # ---------- Settings helpers ----------
+# settings rarely change; keep them in memory for a short while. The cache is
+# per process, so other workers may show the old value for up to the TTL.
+_SETTINGS_TTL = 5.0
+_settings_cache: dict[str, tuple[float, str]] = {}
+
 def get_setting(key, default=""):
-    with get_db() as db:
-        row = db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
-        return row["value"] if row else default
+    cached = _settings_cache.get(key)
+    if cached and time.monotonic() - cached[0] < _SETTINGS_TTL:
+        return cached[1]
+    db = get_db()
+    row = db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    if not row:
+        return default
+    _settings_cache[key] = (time.monotonic(), row["value"])
+    return row["value"]
 
 def set_setting(key, value):
-    with get_db() as db:
-        db.execute("INSERT INTO settings(key,value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
-        db.commit()
+    db = get_db()
+    db.execute("INSERT INTO settings(key,value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+    _settings_cache[key] = (time.monotonic(), value)
+
+@app.template_filter("epoch")
+def format_epoch(ts):
+    if ts is None:
+        return ""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+
+# ---------- Logo helpers ----------
+# stat logo.png at most every few seconds instead of on every page view
+_LOGO_RECHECK = 5.0
+_logo_state = {"exists": False, "mtime": 0.0, "checked": float("-inf")}
+
+def logo_info():
+    now = time.monotonic()
+    if now - _logo_state["checked"] > _LOGO_RECHECK:
+        try:
+            st = os.stat(_LOGO_PATH)
+            _logo_state.update(exists=True, mtime=st.st_mtime)
+        except OSError:
+            _logo_state.update(exists=False, mtime=0.0)
+        _logo_state["checked"] = now
+    return _logo_state
+
+@app.context_processor
+def inject_globals():
+    # logo_version bumps the logo URL whenever the file changes, so cached copies are never stale
+    return {"site_name": get_setting("site_name"), "logo_version": int(logo_info()["mtime"])}
 
 def logged_in():
     return session.get("user") == ADMIN_USER
@@ -90,13 +190,15 @@ def logged_in():
 def login_form():
     if logged_in():
         return redirect(url_for("dashboard"))
-    return render_template("login.html", site_name=get_setting("site_name"))
+    return render_template("login.html")
 
 @app.post("/login")
 def login():
     user = _clean(request.form.get("username",""))
     pw = _clean(request.form.get("password",""))
-    if user == ADMIN_USER and pw == ADMIN_PASSWORD:
+    # compare both fields in constant time; & so neither short-circuits
+    ok = hmac.compare_digest(user.encode(), _ADMIN_USER_B) & hmac.compare_digest(pw.encode(), _ADMIN_PW_B)
+    if ok:
         session["user"] = user
         return redirect(url_for("dashboard"))
     flash("Invalid credentials", "error")
@@ -118,18 +220,11 @@ def home():
 def dashboard():
     if not logged_in():
         return redirect(url_for("login_form"))
-    with get_db() as db:
-        keys = db.execute("""
-            SELECT l.*,
-                   (SELECT COUNT(*) FROM activations a WHERE a.license_id = l.id) as activation_count
-            FROM licenses l
-            ORDER BY l.created_at DESC
-        """).fetchall()
-    return render_template("dashboard.html", keys=keys, site_name=get_setting("site_name"))
+    return render_template("dashboard.html", keys=_list_keys())
 
 @app.get("/validate")
 def validate_page():
-    return render_template("validate.html", site_name=get_setting("site_name"))
+    return render_template("validate.html")
 
 @app.get("/settings")
 def settings_page():
@@ -140,8 +235,8 @@ def settings_page():
         "accent": get_setting("accent"),
     }
     # check if logo exists
-    logo_exists = os.path.exists(os.path.join(app.static_folder, "logo.png"))
-    return render_template("settings.html", data=data, logo_exists=logo_exists, site_name=data["site_name"])
+    logo_exists = logo_info()["exists"]
+    return render_template("settings.html", data=data, logo_exists=logo_exists)
 
 @app.post("/settings")
 def settings_save():
@@ -166,27 +261,51 @@ def upload_logo():
     if ext not in ALLOWED_LOGO_EXT:
         flash("Unsupported file type", "error")
         return redirect(url_for("settings_page"))
-    filename = "logo.png" if ext == "png" else "logo." + ext
-    path = os.path.join(app.static_folder, filename)
-    f.save(path)
-    # standardize to logo.png to match template reference
-    if filename != "logo.png":
-        # convert name by just copying (no image processing)
-        try:
-            os.replace(path, os.path.join(app.static_folder, "logo.png"))
-        except Exception:
-            pass
+    # always stored as logo.png to match the template reference (no image processing)
+    f.save(_LOGO_PATH, buffer_size=1 << 20)
+    _logo_state.update(exists=True, mtime=time.time(), checked=time.monotonic())
     flash("Logo uploaded", "ok")
     return redirect(url_for("settings_page"))
 
 # ---------- Utilities ----------
+def _now_ts() -> int:
+    return int(time.time())
+
+def _http_date(ts):
+    # timestamps are stored as epoch seconds but the API has always returned
+    # them as HTTP dates ("Sat, 14 Nov 2026 11:08:56 GMT")
+    return http_date(ts) if ts is not None else None
+
+def ojson(obj, status=200):
+    # orjson encodes straight to bytes, much faster than jsonify on hot endpoints
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
+
 def generate_key(prefix="FLUX", groups=4, group_len=5):
     alphabet = string.ascii_uppercase + string.digits
-    parts = []
-    for _ in range(groups):
-        parts.append("".join(secrets.choice(alphabet) for _ in range(group_len)))
+    n = groups * group_len
+    # read random bytes in one call and map them onto the alphabet; bytes at or
+    # above `limit` would bias the modulo and are dropped (4 in 256), so the
+    # spare bytes almost always make a second read unnecessary
+    limit = 256 - 256 % len(alphabet)
+    chars = ""
+    while len(chars) < n:
+        chars += "".join(alphabet[b % len(alphabet)] for b in secrets.token_bytes(n + 8) if b < limit)
+    chars = chars[:n]
+    parts = [chars[i:i + group_len] for i in range(0, len(chars), group_len)]
     return f"{prefix}-" + "-".join(parts)
 
+@cache.memoize(timeout=5)
+def _list_keys():
+    db = get_db()
+    rows = db.execute("""
+        SELECT l.*, COALESCE(c.n, 0) as activation_count
+        FROM licenses l
+        LEFT JOIN (SELECT license_id, COUNT(*) as n FROM activations GROUP BY license_id) c
+               ON c.license_id = l.id
+        ORDER BY l.created_at DESC
+    """).fetchall()
+    return [dict(r) for r in rows]
+
 def parse_days(days_str):
     try:
         d = int(days_str)
@@ -209,103 +328,94 @@ def api_create_key():
     except:
         max_activations = 1
     lic_key = generate_key()
-    now = datetime.utcnow()
-    expires_at = (now + timedelta(days=days)) if days else None
-    with get_db() as db:
-        db.execute("""
-            INSERT INTO licenses(lic_key, created_at, expires_at, max_activations, revoked, notes)
-            VALUES (?, ?, ?, ?, 0, ?)
-        """, (lic_key, now, expires_at, max_activations, notes))
-        db.commit()
+    now = _now_ts()
+    expires_at = now + days * 86400 if days else None
+    db = get_db()
+    db.execute("""
+        INSERT INTO licenses(lic_key, created_at, expires_at, max_activations, revoked, notes)
+        VALUES (?, ?, ?, ?, 0, ?)
+    """, (lic_key, now, expires_at, max_activations, notes))
+    cache.delete_memoized(_list_keys)
     return jsonify({"ok": True, "key": lic_key})
 
 @app.post("/api/revoke/<int:lic_id>")
 def api_revoke(lic_id):
     if not logged_in():
         return jsonify({"ok": False, "error": "unauthorized"}), 401
-    with get_db() as db:
-        db.execute("UPDATE licenses SET revoked = 1 WHERE id = ?", (lic_id,))
-        db.commit()
+    db = get_db()
+    db.execute("UPDATE licenses SET revoked = 1 WHERE id = ?", (lic_id,))
+    cache.delete_memoized(_list_keys)
     return jsonify({"ok": True})
 
 @app.post("/api/delete/<int:lic_id>")
 def api_delete(lic_id):
     if not logged_in():
         return jsonify({"ok": False, "error": "unauthorized"}), 401
-    with get_db() as db:
-        db.execute("DELETE FROM licenses WHERE id = ?", (lic_id,))
-        db.commit()
+    db = get_db()
+    db.execute("DELETE FROM licenses WHERE id = ?", (lic_id,))
+    cache.delete_memoized(_list_keys)
     return jsonify({"ok": True})
 
 @app.get("/api/keys")
 def api_keys():
     if not logged_in():
-        return jsonify({"ok": False, "error": "unauthorized"}), 401
-    with get_db() as db:
-        rows = db.execute("""
-            SELECT l.*,
-                   (SELECT COUNT(*) FROM activations a WHERE a.license_id = l.id) as activation_count
-            FROM licenses l
-            ORDER BY l.created_at DESC
-        """).fetchall()
-    items = [dict(r) for r in rows]
-    return jsonify({"ok": True, "items": items})
+        return ojson({"ok": False, "error": "unauthorized"}, 401)
+    items = [dict(k, created_at=_http_date(k["created_at"]), expires_at=_http_date(k["expires_at"]))
+             for k in _list_keys()]
+    return ojson({"ok": True, "items": items})
 
 # ---------- Public validation API ----------
 @app.post("/api/validate")
 def api_validate():
     payload = request.get_json(silent=True) or request.form
-    lic_key = _clean((payload.get("key") or "")).upper()
-    machine_id = _clean(payload.get("machine_id") or "")
-    now = datetime.utcnow()
+    # keys are stored upper-case, so a single upper() lets the lookup use the unique index as-is
+    lic_key = _clean(payload.get("key")).upper()
+    machine_id = _clean(payload.get("machine_id"))
+    now = _now_ts()
 
     if not lic_key:
-        return jsonify({"valid": False, "reason": "missing_key"}), 400
+        return ojson({"valid": False, "reason": "missing_key"}, 400)
     if not machine_id:
-        return jsonify({"valid": False, "reason": "missing_machine_id"}), 400
-
-    with get_db() as db:
-        lic = db.execute("SELECT * FROM licenses WHERE lic_key = ?", (lic_key,)).fetchone()
-        if not lic:
-            return jsonify({"valid": False, "reason": "not_found"}), 404
-        if lic["revoked"]:
-            return jsonify({"valid": False, "reason": "revoked"}), 403
-        if lic["expires_at"] is not None:
-            expires_at = lic["expires_at"]
-            if isinstance(expires_at, str):
-                try:
-                    expires_at = datetime.fromisoformat(expires_at)
-                except Exception:
-                    return jsonify({"valid": False, "reason": "expired"}), 403
-            if now > expires_at:
-                return jsonify({"valid": False, "reason": "expired"}), 403
-
-        activation_count = db.execute("SELECT COUNT(*) FROM activations WHERE license_id = ?", (lic["id"],)).fetchone()[0]
-        existing = db.execute("SELECT * FROM activations WHERE license_id = ? AND machine_id = ?",
-                              (lic["id"], machine_id)).fetchone()
-        if existing:
-            db.execute("UPDATE activations SET last_seen = ? WHERE id = ?", (now, existing["id"]))
-            db.commit()
-        else:
-            if activation_count >= lic["max_activations"]:
-                return jsonify({"valid": False, "reason": "activation_limit"}), 403
-            db.execute("""
-                INSERT INTO activations(license_id, machine_id, activated_at, last_seen)
-                VALUES (?, ?, ?, ?)
-            """, (lic["id"], machine_id, now, now))
-            db.commit()
-
-        remaining = lic["max_activations"] - db.execute("SELECT COUNT(*) FROM activations WHERE license_id = ?", (lic["id"],)).fetchone()[0]
-        return jsonify({
-            "valid": True,
-            "key": lic_key,
-            "expires_at": lic["expires_at"],
-            "remaining_activations": max(0, remaining),
-            "notes": lic["notes"]
-        })
+        return ojson({"valid": False, "reason": "missing_machine_id"}, 400)
+
+    db = get_db()
+    lic = db.execute("SELECT * FROM licenses WHERE lic_key = ?", (lic_key,)).fetchone()
+    if not lic:
+        return ojson({"valid": False, "reason": "not_found"}, 404)
+    if lic["revoked"]:
+        return ojson({"valid": False, "reason": "revoked"}, 403)
+    if lic["expires_at"] is not None and now > lic["expires_at"]:
+        return ojson({"valid": False, "reason": "expired"}, 403)
+
+    # a known machine just refreshes last_seen; a new one is only inserted while
+    # under the limit. No row back means the limit was hit; activated_at only
+    # equals now for a freshly inserted row (or one inserted earlier in the same
+    # second, which just costs an extra cache clear).
+    row = db.execute("""
+        INSERT INTO activations(license_id, machine_id, activated_at, last_seen)
+        SELECT ?1, ?2, ?3, ?3
+        WHERE EXISTS (SELECT 1 FROM activations WHERE license_id = ?1 AND machine_id = ?2)
+           OR (SELECT COUNT(*) FROM activations WHERE license_id = ?1) < ?4
+        ON CONFLICT(license_id, machine_id) DO UPDATE SET last_seen = excluded.last_seen
+        RETURNING activated_at = ?3, (SELECT COUNT(*) FROM activations WHERE license_id = ?1)
+    """, (lic["id"], machine_id, now, lic["max_activations"])).fetchone()
+    if row is None:
+        return ojson({"valid": False, "reason": "activation_limit"}, 403)
+    inserted, activation_count = row
+    if inserted:
+        cache.delete_memoized(_list_keys)
+
+    remaining = lic["max_activations"] - activation_count
+    return ojson({
+        "valid": True,
+        "key": lic_key,
+        "expires_at": _http_date(lic["expires_at"]),
+        "remaining_activations": max(0, remaining),
+        "notes": lic["notes"]
+    })
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
-    print("STATIC FOLDER:", app.static_folder)
+    print("STATIC FOLDER:", _STATIC)
     print(f"Flux Licensing Server running on http://127.0.0.1:{port}")
-    app.run(host="127.0.0.1", port=port, debug=True)
+    app.run(host="127.0.0.1", port=port, debug=FLUX_DEBUG, use_reloader=FLUX_DEBUG)